@@ -19,10 +19,27 @@ from config import ConfigParser
 
 import os
 import numpy as np
+import queue
 import threading
 import time
 from common import load_rgbd_file_names, save_poses, load_intrinsic, extract_trianglemesh, get_default_dataset, extract_rgbd_frames
 
+_IDENTITY4 = np.eye(4)
+_identity4_cache = {}
+
+# Number of poses staged in memory before they are streamed to the
+# memory-mapped trajectory file.
+_POSE_CHUNK = 4096
+
+
+def identity4(device=o3c.Device('CPU:0')):
+    """Return a cached 4x4 identity tensor for the given device, avoiding a
+    fresh NumPy allocation and host-to-device copy per request."""
+    key = str(device)
+    if key not in _identity4_cache:
+        _identity4_cache[key] = o3c.Tensor(_IDENTITY4, device=device)
+    return _identity4_cache[key]
+
 
 def set_enabled(widget, enable):
     widget.enabled = enable
@@ -132,6 +149,23 @@ class ReconstructionWindow:
 
         set_enabled(self.fixed_prop_grid, True)
 
+        ## Snapshot of the slider values used in the SLAM loop. The worker
+        ## thread reads these plain Python scalars instead of crossing into
+        ## the GUI bindings on every frame; the sliders push updates here.
+        self._params = {
+            'depth_scale': float(self.scale_slider.int_value),
+            'depth_max': self.max_slider.double_value,
+            'trunc_multiplier': self.trunc_multiplier_slider.double_value,
+            'interval': self.interval_slider.int_value,
+            'est_point_count': self.est_point_count_slider.int_value,
+        }
+        self._bind_param(self.scale_slider, 'depth_scale', float)
+        self._bind_param(self.max_slider, 'depth_max', float)
+        self._bind_param(self.trunc_multiplier_slider, 'trunc_multiplier',
+                         float)
+        self._bind_param(self.interval_slider, 'interval', int)
+        self._bind_param(self.est_point_count_slider, 'est_point_count', int)
+
         ## Application control
         b = gui.ToggleSwitch('Resume/Pause')
         b.set_on_clicked(self._on_switch)
@@ -190,6 +224,16 @@ class ReconstructionWindow:
         self.widget3d.scene = rendering.Open3DScene(self.window.renderer)
         self.widget3d.scene.set_background([1, 1, 1, 1])
 
+        # Materials never change after construction; share single instances
+        # instead of building a new binding object per add_geometry call.
+        self._pcd_mat = rendering.MaterialRecord()
+        self._pcd_mat.shader = 'defaultUnlit'
+        self._pcd_mat.sRGB_color = True
+
+        self._frustum_mat = rendering.MaterialRecord()
+        self._frustum_mat.shader = 'unlitLine'
+        self._frustum_mat.line_width = 5.0
+
         w.set_on_layout(self._on_layout)
         w.set_on_close(self._on_close)
 
@@ -199,12 +243,29 @@ class ReconstructionWindow:
         self.is_running = False
         self.is_surface_updated = False
 
+        # Signaled while the reconstruction should run (or on shutdown), so
+        # the worker sleeps in an event wait instead of polling while paused.
+        self._resume_event = threading.Event()
+
         self.idx = 0
-        self.poses = []
+        self.poses = np.empty((0, 4, 4))
+        self._pose_chunk = np.empty((_POSE_CHUNK, 4, 4))
+        self._pose_chunk_start = 0
+        self._pose_chunk_len = 0
+
+        # Latest-only render payload. The worker overwrites the slot each
+        # frame; the GUI thread consumes whatever is newest, so stale frames
+        # are dropped instead of queuing up when rendering falls behind.
+        self._render_lock = threading.Lock()
+        self._pending_render = None
 
         # Start running
         threading.Thread(name='UpdateMain', target=self.update_main).start()
 
+    def _bind_param(self, slider, key, cast):
+        slider.set_on_value_changed(
+            lambda value: self._params.update({key: cast(value)}))
+
     def _on_layout(self, ctx):
         em = ctx.theme.font_size
 
@@ -229,6 +290,10 @@ class ReconstructionWindow:
             gui.Application.instance.post_to_main_thread(
                 self.window, self._on_start)
         self.is_running = not self.is_running
+        if self.is_running:
+            self._resume_event.set()
+        else:
+            self._resume_event.clear()
 
     # On start: point cloud buffer and model initialization.
     def _on_start(self):
@@ -238,22 +303,40 @@ class ReconstructionWindow:
             o3c.Tensor(np.zeros((max_points, 3), dtype=np.float32)))
         pcd_placeholder.point.colors = o3c.Tensor(
             np.zeros((max_points, 3), dtype=np.float32))
-        mat = rendering.MaterialRecord()
-        mat.shader = 'defaultUnlit'
-        mat.sRGB_color = True
-        self.widget3d.scene.scene.add_geometry('points', pcd_placeholder, mat)
+        self.widget3d.scene.scene.add_geometry('points', pcd_placeholder,
+                                               self._pcd_mat)
 
         self.model = o3d.t.pipelines.slam.Model(
             self.voxel_size_slider.double_value, 16,
-            self.est_block_count_slider.int_value, o3c.Tensor(np.eye(4)),
+            self.est_block_count_slider.int_value, identity4(),
             o3c.Device(self.config.device))
         self.is_started = True
 
         set_enabled(self.fixed_prop_grid, False)
         set_enabled(self.adjustable_prop_grid, True)
 
+    def _record_pose(self, pose):
+        if self.poses.shape[0] == 0:
+            self.poses = np.lib.format.open_memmap(self._pose_fname,
+                                                   mode='w+',
+                                                   dtype=np.float64,
+                                                   shape=(self._n_files, 4, 4))
+        self._pose_chunk[self._pose_chunk_len] = pose
+        self._pose_chunk_len += 1
+        if self._pose_chunk_len == len(self._pose_chunk):
+            self._flush_poses()
+
+    def _flush_poses(self):
+        end = self._pose_chunk_start + self._pose_chunk_len
+        self.poses[self._pose_chunk_start:end] = \
+            self._pose_chunk[:self._pose_chunk_len]
+        self._pose_chunk_start = end
+        self._pose_chunk_len = 0
+
     def _on_close(self):
         self.is_done = True
+        # Wake the worker so a paused reconstruction shuts down promptly.
+        self._resume_event.set()
 
         if self.is_started:
             print('Saving model to {}...'.format(config.path_npz))
@@ -268,12 +351,13 @@ class ReconstructionWindow:
 
             log_fname = '.'.join(config.path_npz.split('.')[:-1]) + '.log'
             print('Saving trajectory to {}...'.format(log_fname))
-            save_poses(log_fname, self.poses)
+            self._flush_poses()
+            save_poses(log_fname, self.poses[:self.idx])
             print('Finished.')
 
         return True
 
-    def init_render(self, depth_ref, color_ref):
+    def init_render(self, depth_ref, color_ref, frustum):
         self.input_depth_image.update_image(
             depth_ref.colorize_depth(float(self.scale_slider.int_value),
                                      config.depth_min,
@@ -287,36 +371,38 @@ class ReconstructionWindow:
         self.raycast_color_image.update_image(color_ref.to_legacy())
         self.window.set_needs_layout()
 
+        # The frustum is added once; later frames only update its pose via
+        # set_geometry_transform instead of re-uploading the geometry.
+        self.widget3d.scene.add_geometry('frustum', frustum, self._frustum_mat)
+
         bbox = o3d.geometry.AxisAlignedBoundingBox([-5, -5, -5], [5, 5, 5])
         self.widget3d.setup_camera(60, bbox, [0, 0, 0])
         self.widget3d.look_at([0, 0, 0], [0, -1, -3], [0, -1, 0])
 
+    def _flush_render(self):
+        with self._render_lock:
+            payload = self._pending_render
+            self._pending_render = None
+        if payload is not None:
+            self.update_render(*payload)
+
     def update_render(self, input_depth, input_color, raycast_depth,
-                      raycast_color, pcd, frustum):
-        self.input_depth_image.update_image(
-            input_depth.colorize_depth(
-                float(self.scale_slider.int_value), config.depth_min,
-                self.max_slider.double_value).to_legacy())
-        self.input_color_image.update_image(input_color.to_legacy())
+                      raycast_color, pcd, frustum_pose, scene_updated):
+        # Images arrive pre-colorized as legacy CPU images; the GUI thread
+        # only uploads them to the widgets.
+        self.input_depth_image.update_image(input_depth)
+        self.input_color_image.update_image(input_color)
 
-        self.raycast_depth_image.update_image(
-            raycast_depth.colorize_depth(
-                float(self.scale_slider.int_value), config.depth_min,
-                self.max_slider.double_value).to_legacy())
-        self.raycast_color_image.update_image(
-            (raycast_color).to(o3c.uint8, False, 255.0).to_legacy())
+        self.raycast_depth_image.update_image(raycast_depth)
+        self.raycast_color_image.update_image(raycast_color)
 
-        if self.is_scene_updated:
+        if scene_updated:
             if pcd is not None and pcd.point.positions.shape[0] > 0:
                 self.widget3d.scene.scene.update_geometry(
                     'points', pcd, rendering.Scene.UPDATE_POINTS_FLAG |
                     rendering.Scene.UPDATE_COLORS_FLAG)
 
-        self.widget3d.scene.remove_geometry("frustum")
-        mat = rendering.MaterialRecord()
-        mat.shader = "unlitLine"
-        mat.line_width = 5.0
-        self.widget3d.scene.add_geometry("frustum", frustum, mat)
+        self.widget3d.scene.set_geometry_transform("frustum", frustum_pose)
 
     # Major loop
     def update_main(self):
@@ -326,7 +412,20 @@ class ReconstructionWindow:
         n_files = len(color_file_names)
         device = o3d.core.Device(config.device)
 
-        T_frame_to_model = o3c.Tensor(np.identity(4))
+        # The trajectory is streamed to a memory-mapped .npy file: poses are
+        # staged in a fixed-size chunk and flushed in blocks, so RSS stays
+        # bounded however long the capture runs. The file itself is created
+        # lazily by _record_pose, so merely launching the app does not
+        # truncate a previous run's trajectory.
+        self._pose_fname = '.'.join(
+            config.path_npz.split('.')[:-1]) + '_poses.npy'
+        self._n_files = n_files
+
+        T_frame_to_model = identity4()
+        # Host-side copy of the pose, composed incrementally so that the hot
+        # loop never has to synchronize on T_frame_to_model.cpu().
+        T_frame_to_model_np = _IDENTITY4.copy()
+        intrinsic_np = intrinsic.numpy()
         depth_ref = o3d.t.io.read_image(depth_file_names[0])
         color_ref = o3d.t.io.read_image(color_file_names[0])
         input_frame = o3d.t.pipelines.slam.Frame(depth_ref.rows,
@@ -342,8 +441,41 @@ class ReconstructionWindow:
         raycast_frame.set_data_from_image('depth', depth_ref)
         raycast_frame.set_data_from_image('color', color_ref)
 
+        # Build the camera frustum once, in camera coordinates; per-frame
+        # updates only move it with the current pose.
+        frustum = o3d.geometry.LineSet.create_camera_visualization(
+            color_ref.columns, color_ref.rows, intrinsic_np, _IDENTITY4, 0.2)
+        frustum.paint_uniform_color([0.961, 0.475, 0.000])
+
         gui.Application.instance.post_to_main_thread(
-            self.window, lambda: self.init_render(depth_ref, color_ref))
+            self.window,
+            lambda: self.init_render(depth_ref, color_ref, frustum))
+
+        # Decode images and upload them to the device on a background thread,
+        # so that disk I/O and host-to-device copies overlap with tracking and
+        # integration of the previous frames.
+        prefetch_queue = queue.Queue(maxsize=4)
+
+        def prefetch_rgbd():
+            try:
+                for i in range(n_files):
+                    depth = o3d.t.io.read_image(depth_file_names[i]).to(device)
+                    color = o3d.t.io.read_image(color_file_names[i]).to(device)
+                    while not self.is_done:
+                        try:
+                            prefetch_queue.put((depth, color), timeout=0.5)
+                            break
+                        except queue.Full:
+                            continue
+                    if self.is_done:
+                        return
+            finally:
+                # Always unblock the consumer, whether the files ran out, the
+                # window was closed, or read_image raised.
+                prefetch_queue.put(None)
+
+        threading.Thread(name='PrefetchRGBD', target=prefetch_rgbd,
+                         daemon=True).start()
 
         fps_interval_len = 30
         self.idx = 0
@@ -352,11 +484,20 @@ class ReconstructionWindow:
         start = time.time()
         while not self.is_done:
             if not self.is_started or not self.is_running:
-                time.sleep(0.05)
+                self._resume_event.wait(timeout=0.5)
                 continue
 
-            depth = o3d.t.io.read_image(depth_file_names[self.idx]).to(device)
-            color = o3d.t.io.read_image(color_file_names[self.idx]).to(device)
+            depth_scale = self._params['depth_scale']
+            depth_max = self._params['depth_max']
+            trunc_multiplier = self._params['trunc_multiplier']
+            interval = self._params['interval']
+            est_point_count = self._params['est_point_count']
+
+            prefetched = prefetch_queue.get()
+            if prefetched is None:
+                # The producer stopped early (shutdown or a read failure).
+                break
+            depth, color = prefetched
 
             input_frame.set_data_from_image('depth', depth)
             input_frame.set_data_from_image('color', color)
@@ -365,38 +506,32 @@ class ReconstructionWindow:
                 result = self.model.track_frame_to_model(
                     input_frame,
                     raycast_frame,
-                    float(self.scale_slider.int_value),
-                    self.max_slider.double_value,
+                    depth_scale,
+                    depth_max,
                 )
                 T_frame_to_model = T_frame_to_model @ result.transformation
+                T_frame_to_model_np = T_frame_to_model_np \
+                    @ result.transformation.cpu().numpy()
 
-            self.poses.append(T_frame_to_model.cpu().numpy())
+            self._record_pose(T_frame_to_model_np)
             self.model.update_frame_pose(self.idx, T_frame_to_model)
-            self.model.integrate(input_frame,
-                                 float(self.scale_slider.int_value),
-                                 self.max_slider.double_value,
-                                 self.trunc_multiplier_slider.double_value)
-            self.model.synthesize_model_frame(
-                raycast_frame, float(self.scale_slider.int_value),
-                config.depth_min, self.max_slider.double_value,
-                self.trunc_multiplier_slider.double_value,
-                self.raycast_box.checked)
-
-            if (self.idx % self.interval_slider.int_value == 0 and
-                    self.update_box.checked) \
+            self.model.integrate(input_frame, depth_scale, depth_max,
+                                 trunc_multiplier)
+            self.model.synthesize_model_frame(raycast_frame, depth_scale,
+                                              config.depth_min, depth_max,
+                                              trunc_multiplier,
+                                              self.raycast_box.checked)
+
+            if (self.idx % interval == 0 and self.update_box.checked) \
                     or (self.idx == 3) \
                     or (self.idx == n_files - 1):
                 pcd = self.model.voxel_grid.extract_point_cloud(
-                    3.0, self.est_point_count_slider.int_value).to(
-                        o3d.core.Device('CPU:0'))
-                self.is_scene_updated = True
+                    3.0, est_point_count).to(o3d.core.Device('CPU:0'))
+                scene_updated = True
             else:
-                self.is_scene_updated = False
+                scene_updated = False
 
-            frustum = o3d.geometry.LineSet.create_camera_visualization(
-                color.columns, color.rows, intrinsic.numpy(),
-                np.linalg.inv(T_frame_to_model.cpu().numpy()), 0.2)
-            frustum.paint_uniform_color([0.961, 0.475, 0.000])
+            frustum_pose = T_frame_to_model_np.copy()
 
             # Output FPS
             if (self.idx % fps_interval_len == 0):
@@ -409,7 +544,7 @@ class ReconstructionWindow:
             # Output info
             info = 'Frame {}/{}\n\n'.format(self.idx, n_files)
             info += 'Transformation:\n{}\n'.format(
-                np.array2string(T_frame_to_model.numpy(),
+                np.array2string(T_frame_to_model_np,
                                 precision=3,
                                 max_line_width=40,
                                 suppress_small=True))
@@ -418,16 +553,44 @@ class ReconstructionWindow:
                 self.model.voxel_grid.hashmap().capacity())
             info += 'Surface points: {}/{}\n'.format(
                 0 if pcd is None else pcd.point.positions.shape[0],
-                self.est_point_count_slider.int_value)
+                est_point_count)
 
             self.output_info.text = info
 
-            gui.Application.instance.post_to_main_thread(
-                self.window, lambda: self.update_render(
-                    input_frame.get_data_as_image('depth'),
-                    input_frame.get_data_as_image('color'),
-                    raycast_frame.get_data_as_image('depth'),
-                    raycast_frame.get_data_as_image('color'), pcd, frustum))
+            # With surface updates paused, only refresh the view every
+            # interval-th frame; skipping a frame also skips its colorize
+            # kernels and device-to-host image copies.
+            if self.update_box.checked or scene_updated \
+                    or (self.idx % interval == 0):
+                # Colorize and convert the display images here, on the worker
+                # thread: colorize_depth and the fused uint8 cast+scale run
+                # as device kernels, and the GUI thread is left with plain
+                # uploads.
+                input_depth_img = input_frame.get_data_as_image(
+                    'depth').colorize_depth(depth_scale, config.depth_min,
+                                            depth_max).to_legacy()
+                input_color_img = input_frame.get_data_as_image(
+                    'color').to_legacy()
+                raycast_depth_img = raycast_frame.get_data_as_image(
+                    'depth').colorize_depth(depth_scale, config.depth_min,
+                                            depth_max).to_legacy()
+                raycast_color_img = raycast_frame.get_data_as_image('color').to(
+                    o3c.uint8, False, 255.0).to_legacy()
+
+                with self._render_lock:
+                    pending = self._pending_render
+                    if pending is not None:
+                        # Keep the dropped payload's pending point-cloud
+                        # upload alive instead of deferring it to the next
+                        # reconstruction interval.
+                        scene_updated = scene_updated or pending[6]
+                    self._pending_render = (input_depth_img, input_color_img,
+                                            raycast_depth_img,
+                                            raycast_color_img, pcd,
+                                            frustum_pose, scene_updated)
+                if pending is None:
+                    gui.Application.instance.post_to_main_thread(
+                        self.window, self._flush_render)
 
             self.idx += 1
             self.is_done = self.is_done | (self.idx >= n_files)